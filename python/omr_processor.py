@@ -9,7 +9,157 @@ import numpy as np
 import json
 import sys
 import os
-from PIL import Image
+import functools
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, fall back to the standard json module
+    orjson = None
+
+
+def _score_rois_numpy(binary, coords, min_ratio, min_pixels, min_circularity):
+    """
+    Measure the dark pixels in every mark region and decide which ones are marked
+    
+    Circularity compares the dark pixel count with the area of a filled disk
+    having the same spread (second moment) of dark pixels: close to 1 for a
+    filled circle or solid block, low for scattered strokes and noise. It is
+    only measured for regions that pass the dark pixel checks (0 otherwise).
+    
+    Args:
+        binary (np.ndarray): Thresholded form, dark pixels are 0
+        coords (np.ndarray): (N, 4) int32 array of x, y, width, height per mark
+        min_ratio (float): Minimum dark pixel ratio for a mark
+        min_pixels (int): Minimum absolute dark pixels for a mark
+        min_circularity (float): Minimum circularity for a mark
+        
+    Returns:
+        tuple: (dark_counts, confidences, circularities, is_marked) arrays of length N
+    """
+    n = coords.shape[0]
+    dark_counts = np.zeros(n, dtype=np.int64)
+    confidences = np.zeros(n, dtype=np.float64)
+    circularities = np.zeros(n, dtype=np.float64)
+    
+    x, y, w, h = coords.T
+    valid = (w > 0) & (h > 0)
+    
+    # Dark pixel counts for all regions from a summed-area table: four
+    # lookups per region, independent of its size (white pixels are 255)
+    sat = cv2.integral(binary)
+    white_sums = sat[y + h, x + w] - sat[y, x + w] - sat[y + h, x] + sat[y, x]
+    dark_counts[valid] = w[valid] * h[valid] - white_sums[valid] // 255
+    confidences[valid] = dark_counts[valid] / (w[valid] * h[valid])
+    
+    # Only regions that pass the cheap checks need their shape measured
+    candidates = np.flatnonzero(valid & (confidences >= min_ratio) & (dark_counts >= min_pixels))
+    for i in candidates:
+        roi = binary[y[i]:y[i]+h[i], x[i]:x[i]+w[i]]
+        # Dark pixels are the foreground of the moments
+        m = cv2.moments(cv2.bitwise_not(roi), binaryImage=True)
+        variance = (m["mu20"] + m["mu02"]) / m["m00"]
+        if variance > 0:
+            circularities[i] = m["m00"] / (2 * np.pi * variance)
+    
+    is_marked = (
+        (confidences >= min_ratio) &
+        (dark_counts >= min_pixels) &
+        (circularities > min_circularity)
+    )
+    return dark_counts, confidences, circularities, is_marked
+
+
+def _score_rois_kernel(binary, coords, min_ratio, min_pixels, min_circularity):
+    """Single-pass equivalent of _score_rois_numpy, compiled by _enable_jit"""
+    n = coords.shape[0]
+    dark_counts = np.zeros(n, dtype=np.int64)
+    confidences = np.zeros(n, dtype=np.float64)
+    circularities = np.zeros(n, dtype=np.float64)
+    is_marked = np.zeros(n, dtype=np.bool_)
+    
+    for i in range(n):
+        x0, y0, w, h = coords[i, 0], coords[i, 1], coords[i, 2], coords[i, 3]
+        if w <= 0 or h <= 0:
+            continue
+        
+        # Dark pixel count plus first and second moments in one scan
+        dark = 0
+        sx = 0.0
+        sy = 0.0
+        sxx = 0.0
+        syy = 0.0
+        for y in range(h):
+            for x in range(w):
+                if binary[y0 + y, x0 + x] == 0:
+                    dark += 1
+                    sx += x
+                    sy += y
+                    sxx += x * x
+                    syy += y * y
+        
+        confidence = dark / (w * h)
+        dark_counts[i] = dark
+        confidences[i] = confidence
+        if confidence >= min_ratio and dark >= min_pixels:
+            mx = sx / dark
+            my = sy / dark
+            variance = sxx / dark - mx * mx + syy / dark - my * my
+            if variance > 0:
+                circularities[i] = dark / (2 * np.pi * variance)
+        
+        is_marked[i] = (
+            confidence >= min_ratio and
+            dark >= min_pixels and
+            circularities[i] > min_circularity
+        )
+    
+    return dark_counts, confidences, circularities, is_marked
+
+
+# Plain NumPy scoring by default: importing numba and loading the compiled
+# kernel costs far more than scoring one form, so only long-lived processes
+# (daemon mode, batch workers) switch to the kernel
+_score_rois = _score_rois_numpy
+
+
+def _enable_jit():
+    """
+    Switch mark scoring to the numba-compiled kernel, if numba is installed
+    
+    The kernel is compiled (or loaded from the on-disk cache) and warmed up
+    with a dummy call using the same argument types as process_form.
+    
+    Returns:
+        bool: True if the compiled kernel is now in use
+    """
+    global _score_rois
+    try:
+        from numba import njit
+    except ImportError:  # numba is optional, keep the NumPy implementation
+        return False
+    
+    kernel = njit(cache=True, fastmath=True)(_score_rois_kernel)
+    dummy_coords = np.zeros((1, 4), dtype=np.int32)
+    dummy_coords.setflags(write=False)
+    kernel(np.zeros((1, 1), dtype=np.uint8), dummy_coords, 0.0, 0, 0.0)
+    _score_rois = kernel
+    return True
+
+
+def _dumps(result):
+    """Serialize a processing result to a line of JSON bytes"""
+    if orjson is not None:
+        return orjson.dumps(result, option=orjson.OPT_APPEND_NEWLINE)
+    return (json.dumps(result) + "\n").encode()
+
+
+def _init_worker():
+    """Keep OpenCV single-threaded inside batch worker processes"""
+    # The pool already uses every core; OpenCV's own threads would oversubscribe them
+    cv2.setNumThreads(1)
+    _enable_jit()
+
 
 class OMRProcessor:
     def __init__(self):
@@ -43,157 +193,217 @@ class OMRProcessor:
             {"type": "selection", "item": "beef", "x": 0.55, "y": 0.21, "width": 0.03, "height": 0.03},
         ]
         
-        # Threshold for considering a mark as filled (percentage of dark pixels)
-        self.mark_threshold = 0.6  # 60% dark pixels = marked (very conservative to avoid false positives)
+        # Parallel arrays of the layout above, in mark_positions order, so
+        # processing indexes arrays instead of looking up dict keys
+        self._rel_coords = np.array(
+            [(pos["x"], pos["y"], pos["width"], pos["height"]) for pos in self.mark_positions]
+        )
+        self._mark_types = tuple(pos["type"] for pos in self.mark_positions)
+        self._item_names = tuple(pos["item"] for pos in self.mark_positions)
+        self._is_selection = np.array([t == "selection" for t in self._mark_types], dtype=bool)
+        
+        # Absolute mark coordinates per scan (width, height) (see configure);
+        # only the most recent sizes are kept, a daemon may see many
+        self._coords_cache = {}
+        self._coords_cache_size = 8
+        
+        # Longest image side (pixels) that forms are processed at
+        self.max_image_dimension = 800
+        
+        # Binarization: "otsu" (global) or "adaptive" (uneven lighting)
+        self.threshold_method = "otsu"
+        
+        # For filled circles, we expect:
+        # 1. Significant dark area (at least 35% of the region) - lowered from 40%
+        # 2. Minimum absolute dark pixels (at least 80 pixels) - lowered from 100
+        # 3. Not just noise or shadows (a compact, roughly circular dark area)
+        self.min_dark_ratio = 0.35  # 35% of region should be dark
+        self.min_dark_pixels = 80   # At least 80 dark pixels
+        self.min_circularity = 0.3  # Filled circle ~1.0, scattered strokes much lower
+        
+    def _processing_size(self, width, height):
+        """
+        Size a scan is processed at, after downscaling to max_image_dimension
+        
+        Args:
+            width (int): Scan width in pixels
+            height (int): Scan height in pixels
+            
+        Returns:
+            tuple: (width, height, scale) of the processed image
+        """
+        scale = min(1.0, self.max_image_dimension / max(width, height))
+        if scale < 1.0:
+            width, height = round(width * scale), round(height * scale)
+        return width, height, scale
+        
+    def configure(self, width, height):
+        """
+        Precompute absolute mark coordinates for a known scan size
+        
+        Scanned forms almost always share a resolution, so the result is
+        cached per scan size. process_form calls this for sizes it has not
+        seen yet; call it up front when the scan resolution is known.
+        
+        Args:
+            width (int): Scan width in pixels, before downscaling
+            height (int): Scan height in pixels, before downscaling
+            
+        Returns:
+            np.ndarray: (N, 4) int32 array of x, y, width, height per mark,
+            in the pixels of the downscaled image that is processed
+        """
+        scan_size = (width, height)
+        width, height, _ = self._processing_size(width, height)
+        
+        # Convert relative coordinates to absolute coordinates
+        coords = (self._rel_coords * np.array([width, height, width, height])).astype(np.int32)
+        xy = coords[:, :2]
+        wh = coords[:, 2:]
+        size = np.array([width, height], dtype=np.int32)
+        
+        # Ensure coordinates are within image bounds
+        np.maximum(np.minimum(xy, size - wh), 0, out=xy)
+        np.minimum(wh, size - xy, out=wh)
         
-    def process_form(self, image_path):
+        coords.setflags(write=False)
+        if len(self._coords_cache) >= self._coords_cache_size:
+            # Evict the oldest size (dicts keep insertion order)
+            del self._coords_cache[next(iter(self._coords_cache))]
+        self._coords_cache[scan_size] = coords
+        return coords
+        
+    def process_form(self, image_path, verbose=False):
         """
         Process OMR form and return detected marks
         
         Args:
             image_path (str): Path to the scanned form image
+            verbose (bool): Include per-mark detection details ("marks") in
+                the result instead of only the marked items
             
         Returns:
             dict: Processing results with detected marks and confidence scores
         """
         try:
-            # Load image
-            image = cv2.imread(image_path)
-            if image is None:
+            # Load image, decoding straight to grayscale
+            gray = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
+            if gray is None:
                 return {"success": False, "error": "Could not load image"}
             
-            # Convert to grayscale
-            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+            # Downscale large scans; the marks sit at fixed relative positions
+            # and are still well resolved at max_image_dimension pixels
+            original_height, original_width = gray.shape
+            width, height, scale = self._processing_size(original_width, original_height)
+            if scale < 1.0:
+                gray = cv2.resize(gray, (width, height), interpolation=cv2.INTER_AREA)
             
             # Image preprocessing for better accuracy
-            # Apply Gaussian blur to reduce noise
+            # Apply Gaussian blur to reduce noise (once, for the whole form)
             blurred = cv2.GaussianBlur(gray, (3, 3), 0)
             
-            # Apply histogram equalization to improve contrast
-            equalized = cv2.equalizeHist(blurred)
+            coords = self._coords_cache.get((original_width, original_height))
+            if coords is None:
+                coords = self.configure(original_width, original_height)
+            x, y, w, h = coords.T
+            
+            # Focused mark detection - detect dark filled areas (filled circles)
+            # Threshold the whole form once instead of once per mark region.
+            # Use a global Otsu threshold, or adaptive thresholding when
+            # lighting varies across the form.
+            # Always threshold the blurred grayscale itself. Do not add a
+            # contrast step (equalizeHist, CLAHE, normalize) in between: on a
+            # mostly-white form it pushes the Otsu cut down to a few gray
+            # levels and filled bubbles stop registering as dark
+            if self.threshold_method == "adaptive":
+                binary = cv2.adaptiveThreshold(blurred, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 21, 2)
+            else:
+                _, binary = cv2.threshold(blurred, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+            
+            # Count dark pixels (marks are dark filled areas) and check that
+            # they form a compact filled shape, for every region in one call
+            dark_counts, confidences, circularities, is_marked_all = _score_rois(
+                binary, coords, self.min_dark_ratio, self.min_dark_pixels, self.min_circularity
+            )
+            valid = np.flatnonzero((w > 0) & (h > 0))
+            
+            # Track marked items for selection type marks
+            marked_items = [self._item_names[i] for i in np.flatnonzero(is_marked_all & self._is_selection)]
+            
+            # Calculate overall confidence
+            overall_confidence = float(confidences[valid].mean()) if valid.size else 0
+            
+            if not verbose:
+                return {
+                    "success": True,
+                    "confidence": overall_confidence,
+                    "marked_items": marked_items
+                }
             
-            # Use the preprocessed image
-            processed_image = equalized
+            min_dark_ratio = self.min_dark_ratio
+            min_dark_pixels = self.min_dark_pixels
+            min_circularity = self.min_circularity
             
-            # Get image dimensions
-            height, width = processed_image.shape
+            # Positions are reported in original-image pixels, pixel counts in
+            # the processed image (see processing_scale in the result).
+            # Convert the per-mark arrays to Python values in one go, so the
+            # result holds plain ints, floats and bools (json.dumps-safe)
+            positions = (coords / scale).astype(np.int32).tolist()
+            total_counts = (w * h).tolist()
+            dark_counts = dark_counts.tolist()
+            confidences = confidences.tolist()
+            circularities = circularities.tolist()
+            is_marked_all = is_marked_all.tolist()
             
             # Process each mark position
             marks = []
-            marked_items = []
-            total_confidence = 0
-            
-            for pos in self.mark_positions:
-                # Convert relative coordinates to absolute coordinates
-                x = int(pos["x"] * width)
-                y = int(pos["y"] * height)
-                w = int(pos["width"] * width)
-                h = int(pos["height"] * height)
-                
-                # Ensure coordinates are within image bounds
-                x = max(0, min(x, width - w))
-                y = max(0, min(y, height - h))
-                w = min(w, width - x)
-                h = min(h, height - y)
-                
-                mark_region = processed_image[y:y+h, x:x+w]
-                
-                if mark_region.size == 0:
-                    continue
-                
-                # Focused mark detection - detect dark filled areas (filled circles)
-                total_pixels = mark_region.size
-                
-                # Preprocess for better detection
-                # Apply Gaussian blur to reduce noise
-                blurred = cv2.GaussianBlur(mark_region, (3, 3), 0)
-                
-                # Use adaptive thresholding to handle varying lighting
-                binary = cv2.adaptiveThreshold(blurred, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 11, 2)
-                
-                # Count dark pixels (marks are dark filled areas)
-                dark_pixels = np.sum(binary == 0)
-                white_pixels = total_pixels - dark_pixels
-                
-                # Calculate confidence based on dark pixel ratio
-                confidence = dark_pixels / total_pixels if total_pixels > 0 else 0
-                
-                # For filled circles, we expect:
-                # 1. Significant dark area (at least 35% of the region) - lowered from 40%
-                # 2. Minimum absolute dark pixels (at least 80 pixels) - lowered from 100
-                # 3. Not just noise or shadows
-                min_dark_ratio = 0.35  # 35% of region should be dark
-                min_dark_pixels = 80   # At least 80 dark pixels
-                
-                # Additional validation: check if the dark area forms a coherent shape
-                # by analyzing the distribution of dark pixels
-                if dark_pixels > 0:
-                    # Find contours of dark areas
-                    contours, _ = cv2.findContours(binary, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-                    
-                    # Check if we have a substantial filled area
-                    largest_contour_area = 0
-                    if contours:
-                        largest_contour_area = max(cv2.contourArea(c) for c in contours)
-                    
-                    # A filled circle should have a substantial single contour
-                    # representing most of the dark pixels
-                    contour_coverage = largest_contour_area / dark_pixels if dark_pixels > 0 else 0
-                    
-                    # Mark is detected if:
-                    # 1. High dark pixel ratio (significant filling)
-                    # 2. Sufficient absolute dark pixels
-                    # 3. Either good contour coverage OR very high dark pixel ratio
-                    is_marked = (
-                        confidence >= min_dark_ratio and
-                        dark_pixels >= min_dark_pixels and
-                        (contour_coverage > 0.2 or confidence > 0.5)  # More flexible: good shape OR high fill
-                    )
-                else:
-                    is_marked = False
-                
+            
+            for i in valid.tolist():
+                total_pixels = total_counts[i]
+                dark_pixels = dark_counts[i]
+                confidence = confidences[i]
                 
                 # Create mark result with filled area detection information
                 mark_result = {
-                    "type": pos["type"],
-                    "item": pos["item"],
+                    "type": self._mark_types[i],
+                    "item": self._item_names[i],
                     "position": {
-                        "x": int(x),
-                        "y": int(y),
-                        "width": int(w),
-                        "height": int(h)
+                        "x": positions[i][0],
+                        "y": positions[i][1],
+                        "width": positions[i][2],
+                        "height": positions[i][3]
                     },
-                    "isMarked": bool(is_marked),
-                    "confidence": float(confidence),
-                    "whitePixels": int(white_pixels),
-                    "totalPixels": int(total_pixels),
-                    "darkPixels": int(dark_pixels),
-                    "minDarkRatio": float(min_dark_ratio),
-                    "minDarkPixels": int(min_dark_pixels),
-                    "contourCoverage": float(largest_contour_area / dark_pixels) if dark_pixels > 0 else 0.0,
+                    "isMarked": is_marked_all[i],
+                    "confidence": confidence,
+                    "whitePixels": total_pixels - dark_pixels,
+                    "totalPixels": total_pixels,
+                    "darkPixels": dark_pixels,
+                    "minDarkRatio": min_dark_ratio,
+                    "minDarkPixels": min_dark_pixels,
+                    "minCircularity": min_circularity,
+                    "circularity": circularities[i],
                     "detectionMethod": "filled_area_analysis",
                     "validationPassed": {
-                        "darkRatioCheck": bool(confidence >= min_dark_ratio),
-                        "darkPixelsCheck": bool(dark_pixels >= min_dark_pixels),
-                        "contourCoverageCheck": bool((largest_contour_area / dark_pixels) > 0.2 or confidence > 0.5) if dark_pixels > 0 else False
+                        "darkRatioCheck": confidence >= min_dark_ratio,
+                        "darkPixelsCheck": dark_pixels >= min_dark_pixels,
+                        "circularityCheck": circularities[i] > min_circularity
                     }
                 }
                 
                 marks.append(mark_result)
-                total_confidence += confidence
-                
-                # Track marked items for selection type marks
-                if is_marked and pos["type"] == "selection":
-                    marked_items.append(pos["item"])
-            
-            # Calculate overall confidence
-            overall_confidence = total_confidence / len(marks) if marks else 0
             
             return {
                 "success": True,
                 "marks": marks,
                 "confidence": overall_confidence,
                 "image_dimensions": {
+                    "width": original_width,
+                    "height": original_height
+                },
+                # Pixel counts are measured on the downscaled image; divide
+                # them by processing_scale ** 2 for original-image pixels
+                "processing_scale": scale,
+                "processed_dimensions": {
                     "width": width,
                     "height": height
                 },
@@ -204,23 +414,78 @@ class OMRProcessor:
         except Exception as e:
             return {"success": False, "error": str(e)}
 
+    def process_batch(self, paths, workers=None, verbose=False):
+        """
+        Process several OMR forms in parallel
+        
+        Args:
+            paths (list): Paths to the scanned form images
+            workers (int): Number of worker processes (default: CPU count)
+            verbose (bool): Passed through to process_form
+            
+        Returns:
+            list: One process_form result per path, in the same order
+        """
+        paths = list(paths)
+        if not paths:
+            return []
+        
+        # Every worker pays the numba import in _init_worker, so never start
+        # more than there are forms; keep chunks small enough that a short
+        # batch is still spread over all of them
+        workers = min(workers or os.cpu_count() or 1, len(paths))
+        chunksize = max(1, len(paths) // (workers * 4))
+        
+        process = functools.partial(self.process_form, verbose=verbose)
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as executor:
+            return list(executor.map(process, paths, chunksize=chunksize))
+
+def run_daemon(processor):
+    """
+    Process image paths read from stdin, one per line, until EOF
+    
+    Each result is written as one line of JSON, so a long-lived process
+    pays the interpreter and library startup cost only once.
+    """
+    _enable_jit()
+    for line in sys.stdin:
+        image_path = line.strip()
+        if not image_path:
+            continue
+        
+        result = processor.process_form(image_path, verbose=True)
+        sys.stdout.buffer.write(_dumps(result))
+        sys.stdout.buffer.flush()
+
 def main():
     """Main function for command line usage"""
-    if len(sys.argv) != 2:
-        print("Usage: python omr_processor.py <image_path>", flush=True)
+    # --daemon reads image paths from stdin and takes no other arguments
+    if len(sys.argv) < 2 or (sys.argv[1] == "--daemon" and len(sys.argv) > 2):
+        print("Usage: python omr_processor.py <image_path> [<image_path> ...]", flush=True)
+        print("       python omr_processor.py --daemon  (image paths on stdin)", flush=True)
         sys.exit(1)
     
-    image_path = sys.argv[1]
+    if sys.argv[1] == "--daemon":
+        run_daemon(OMRProcessor())
+        return
     
-    if not os.path.exists(image_path):
-        print(f"Error: Image file not found: {image_path}", flush=True)
-        sys.exit(1)
+    image_paths = sys.argv[1:]
+    
+    for image_path in image_paths:
+        if not os.path.exists(image_path):
+            print(f"Error: Image file not found: {image_path}", flush=True)
+            sys.exit(1)
     
     processor = OMRProcessor()
-    result = processor.process_form(image_path)
+    # The POS backend and web UI read the per-mark details
+    if len(image_paths) == 1:
+        result = processor.process_form(image_paths[0], verbose=True)
+    else:
+        result = processor.process_batch(image_paths, verbose=True)
     
     # Output only JSON result (no debug messages)
-    print(json.dumps(result, indent=2), flush=True)
+    sys.stdout.buffer.write(_dumps(result))
+    sys.stdout.buffer.flush()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+Regression checks for the OMR processor
+
+Forms are drawn on the processor's own mark_positions layout (the bundled
+sample images do not line up with it), so the expected marks are known.
+
+Run with: python -m unittest python/test_omr_processor.py
+"""
+
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from omr_processor import OMRProcessor
+
+
+def draw_form(processor, width, height, filled_items, noise=0.0, seed=0):
+    """
+    Draw a form with a printed ring at every mark position
+
+    Args:
+        processor (OMRProcessor): Processor whose layout is drawn
+        width (int): Image width in pixels
+        height (int): Image height in pixels
+        filled_items (set): Items whose quantity and selection marks are filled
+        noise (float): Standard deviation of Gaussian scanner noise
+        seed (int): Seed for the noise generator
+
+    Returns:
+        np.ndarray: Grayscale form image
+    """
+    image = np.full((height, width), 240.0)
+    for pos in processor.mark_positions:
+        center = (int((pos["x"] + pos["width"] / 2) * width),
+                  int((pos["y"] + pos["height"] / 2) * height))
+        radius = int(min(pos["width"] * width, pos["height"] * height) * 0.45)
+        thickness = -1 if pos["item"] in filled_items else max(1, radius // 8)
+        cv2.circle(image, center, radius, 20, thickness)
+
+    if noise:
+        image += np.random.default_rng(seed).normal(0, noise, image.shape)
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+
+class TestSyntheticForms(unittest.TestCase):
+    SIZES = [(800, 600), (1600, 1200), (3000, 4000)]
+    NOISE_LEVELS = [0, 4, 12]
+
+    def setUp(self):
+        self.processor = OMRProcessor()
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def process(self, image, **kwargs):
+        path = os.path.join(self.tmpdir.name, "form.png")
+        cv2.imwrite(path, image)
+        return self.processor.process_form(path, **kwargs)
+
+    def check_marked_items(self, filled_items):
+        expected = [item for item in self.processor._item_names[1::2] if item in filled_items]
+        for width, height in self.SIZES:
+            for noise in self.NOISE_LEVELS:
+                with self.subTest(size=(width, height), noise=noise):
+                    image = draw_form(self.processor, width, height, filled_items, noise)
+                    result = self.process(image)
+                    self.assertTrue(result["success"], result)
+                    self.assertEqual(result["marked_items"], expected)
+
+    def test_empty_form_has_no_marks(self):
+        self.check_marked_items(set())
+
+    def test_filled_marks_are_detected(self):
+        self.check_marked_items({"isda", "Chicken", "gatas"})
+
+    def test_verbose_result_is_json_serializable(self):
+        image = draw_form(self.processor, 1600, 1200, {"isda"})
+        result = self.process(image, verbose=True)
+        self.assertTrue(result["success"], result)
+        decoded = json.loads(json.dumps(result))
+        self.assertEqual(decoded["marked_items"], ["isda"])
+        self.assertEqual(len(decoded["marks"]), len(self.processor.mark_positions))
+        self.assertEqual(decoded["processing_scale"], 0.5)
+        self.assertEqual(decoded["processed_dimensions"], {"width": 800, "height": 600})
+
+    def test_missing_image(self):
+        result = self.processor.process_form(os.path.join(self.tmpdir.name, "missing.png"))
+        self.assertFalse(result["success"])
+
+
+class TestCoordinateCache(unittest.TestCase):
+    def setUp(self):
+        self.processor = OMRProcessor()
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_configure_uses_scan_size(self):
+        coords = self.processor.configure(3000, 4000)
+        path = os.path.join(self.tmpdir.name, "form.png")
+        cv2.imwrite(path, draw_form(self.processor, 3000, 4000, set()))
+
+        result = self.processor.process_form(path)
+        self.assertTrue(result["success"], result)
+        self.assertEqual(list(self.processor._coords_cache), [(3000, 4000)])
+        self.assertIs(self.processor._coords_cache[(3000, 4000)], coords)
+
+    def test_cache_is_bounded(self):
+        for width in range(100, 120):
+            self.processor.configure(width, 100)
+        self.assertEqual(len(self.processor._coords_cache), self.processor._coords_cache_size)
+        self.assertIn((119, 100), self.processor._coords_cache)
+        self.assertNotIn((100, 100), self.processor._coords_cache)
+
+
+if __name__ == "__main__":
+    unittest.main()